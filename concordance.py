@@ -2,11 +2,14 @@
 
 import os
 import re
+import math
 import click
 import torch
+import pandas as pd
 import slideflow as sf
 
-from typing import List
+from statistics import NormalDist
+from typing import Dict, List, Tuple
 from slideflow.gan.interpolate import StyleGAN2Interpolator
 
 # Allow GPU memory growth, so Tensorflow & PyTorch can play nice
@@ -31,6 +34,30 @@ def num_range(s: str) -> List[int]:
         vals = s.split(',')
         return [int(x) for x in vals]
 
+
+def wilson_interval(count: int, n: int, level: float = 0.95) -> Tuple[float, float]:
+    '''Return the Wilson score confidence interval for a binomial proportion.'''
+
+    z = NormalDist().inv_cdf(0.5 + level / 2)
+    p = count / n
+    center = (p + z**2 / (2*n)) / (1 + z**2 / n)
+    margin = (z / (1 + z**2 / n)) * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2))
+    return max(center - margin, 0.), min(center + margin, 1.)
+
+
+def concordance_intervals(
+    df: pd.DataFrame,
+    level: float = 0.95
+) -> Dict[str, Tuple[float, float, float]]:
+    '''Return the proportion and confidence interval for each concordance category.'''
+
+    n = len(df)
+    intervals = {}
+    for category in ('none', 'weak', 'strong'):
+        count = (df.concordance == category).sum()
+        intervals[category] = (count / n, *wilson_interval(count, n, level))
+    return intervals
+
 # -----------------------------------------------------------------------------
 
 @click.command()
@@ -53,6 +80,11 @@ def num_range(s: str) -> List[int]:
 @click.option('--batch', help='Batch size', type=int, default=32)
 @click.option('--trunc', 'truncation_psi', type=float, help='Truncation psi', default=1, show_default=True)
 @click.option('--noise-mode', help='Noise mode', type=click.Choice(['const', 'random', 'none']), default='const', show_default=True)
+
+# Sequential sampling.
+@click.option('--ci_width', help='Stop once all concordance confidence intervals are narrower than this width', type=click.FloatRange(0, 1, min_open=True), default=None)
+@click.option('--ci_level', help='Confidence level for concordance intervals', type=click.FloatRange(0, 1, min_open=True, max_open=True), default=0.95, show_default=True)
+@click.option('--step',     help='Number of seeds evaluated between stopping checks', type=click.IntRange(min=1), default=100, show_default=True)
 def main(
     out,
     network,
@@ -66,10 +98,17 @@ def main(
     end,
     batch,
     truncation_psi,
-    noise_mode
+    noise_mode,
+    ci_width,
+    ci_level,
+    step
 ):
     """Determine classifier concordance for some seeds."""
 
+    seeds = list(seeds)
+    if not seeds:
+        raise click.BadParameter('At least one seed is required.', param_hint='--seeds')
+
     # Initial preparation.
     device = torch.device('cuda')
     classifier_cfg = sf.util.get_model_config(classifier)
@@ -84,17 +123,36 @@ def main(
         device=device
     )
 
-    # Perform classifier concordance search.
+    # Perform classifier concordance search. If a target interval width is
+    # given, seeds are evaluated in steps until all intervals are narrower.
     interpolator.set_feature_model(classifier)
-    df = interpolator.seed_search(
-        seeds,
-        batch_size=batch,
-        outcome_idx=outcome_idx,
-        concordance_thresholds=[thresh_low, thresh_mid, thresh_high]
-    )
-    print("Percent none:   ", len(df.loc[df.concordance == 'none']) / 10)
-    print("Percent weak:   ", len(df.loc[df.concordance == 'weak']) / 10)
-    print("Percent strong: ", len(df.loc[df.concordance == 'strong']) / 10)
+    if ci_width is None:
+        step = len(seeds)
+    dfs = []
+    for i in range(0, len(seeds), step):
+        dfs.append(interpolator.seed_search(
+            seeds[i:i+step],
+            batch_size=batch,
+            outcome_idx=outcome_idx,
+            concordance_thresholds=[thresh_low, thresh_mid, thresh_high]
+        ))
+        df = pd.concat(dfs, ignore_index=True)
+        intervals = concordance_intervals(df, level=ci_level)
+        if ci_width is not None:
+            widest = max(high - low for _, low, high in intervals.values())
+            print(f"Evaluated {len(df)} seeds; widest interval {widest:.3f}")
+            if widest <= ci_width:
+                break
+
+    # Report concordance.
+    if ci_width is not None:
+        if widest <= ci_width:
+            print(f"Reached interval width {ci_width} after {len(df)} of {len(seeds)} seeds.")
+        else:
+            print(f"Warning: interval width {ci_width} not reached after all {len(seeds)} seeds.")
+    for category, (prop, low, high) in intervals.items():
+        print(f"Percent {category+':':8s}{prop*100:6.1f}  "
+              f"({ci_level*100:g}% CI {low*100:.1f} - {high*100:.1f})")
 
     # Save results to csv.
     df[['seed', 'pred_start', 'pred_end', 'concordance']].to_csv(out)
@@ -13,7 +13,8 @@ from utils import prepare_project, resolve_relative_paths, EasyDict
 @click.option('--exp',      help='Experiment configuration',     metavar='PATH', required=True)
 @click.option('--download', help='Download slides from TCGA',    metavar=bool,   default=False, is_flag=True)
 @click.option('--md5',      help='Verify slide integrity via MD5 hash.',  metavar=bool, default=False, is_flag=True)
-def main(outdir, exp, download, md5):
+@click.option('--pipeline', help='Download, verify, and extract tiles from each slide in a pipeline.', metavar=bool, default=False, is_flag=True)
+def main(outdir, exp, download, md5, pipeline):
     # --- Project initialization ----------------------------------------------
 
     # Load experiment configuration.
@@ -21,12 +22,14 @@ def main(outdir, exp, download, md5):
     cfg = resolve_relative_paths(cfg, dirname(exp))
     if outdir is None:
         outdir = abspath(cfg.name)
-    P = prepare_project(outdir, cfg=cfg, md5=md5, download=download)
+    P = prepare_project(outdir, cfg=cfg, md5=md5, download=download, pipeline=pipeline)
 
     # --- Tile extraction -----------------------------------------------------
-    print("Extracting tiles...")
+    # With --pipeline, tiles have already been extracted by prepare_project.
     dataset = P.dataset(tile_px=cfg.tile_px, tile_um=cfg.tile_um)
-    dataset.extract_tiles(**cfg.tile_kwargs)
+    if not pipeline:
+        print("Extracting tiles...")
+        dataset.extract_tiles(**cfg.tile_kwargs)
 
     # --- Tile extraction -----------------------------------------------------
     print("Initializing classifier training...")
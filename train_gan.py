@@ -3,7 +3,7 @@
 import click
 import slideflow as sf
 
-from os.path import abspath, dirname
+from os.path import abspath, dirname, join
 from utils import prepare_project, resolve_relative_paths, EasyDict
 
 # -----------------------------------------------------------------------------
@@ -13,7 +13,9 @@ from utils import prepare_project, resolve_relative_paths, EasyDict
 @click.option('--exp',      help='Experiment configuration',     metavar='PATH', required=True)
 @click.option('--download', help='Download slides from TCGA',    metavar=bool,   default=False, is_flag=True)
 @click.option('--md5',      help='Verify slide integrity via MD5 hash.',  metavar=bool, default=False, is_flag=True)
-def main(outdir, exp, download, md5):
+@click.option('--pipeline', help='Download, verify, and extract tiles from each slide in a pipeline.', metavar=bool, default=False, is_flag=True)
+@click.option('--cache',    help='Train from a decoded, memory-mapped tile cache.', metavar=bool, default=False, is_flag=True)
+def main(outdir, exp, download, md5, pipeline, cache):
     """Train a GAN using a predetermined experiment configuration."""
 
     # --- Project initialization ----------------------------------------------
@@ -23,14 +25,33 @@ def main(outdir, exp, download, md5):
     cfg = resolve_relative_paths(cfg, dirname(exp))
     if outdir is None:
         outdir = abspath(cfg.name)
-    P = prepare_project(outdir, cfg=cfg, md5=md5, download=download)
+    P = prepare_project(outdir, cfg=cfg, md5=md5, download=download, pipeline=pipeline)
 
     # --- Tile extraction -----------------------------------------------------
-    print("Extracting tiles...")
+    # With --pipeline, tiles have already been extracted by prepare_project.
     dataset = P.dataset(tile_px=cfg.tile_px, tile_um=cfg.tile_um)
-    dataset.extract_tiles(**cfg.tile_kwargs)
+    if not pipeline:
+        print("Extracting tiles...")
+        dataset.extract_tiles(**cfg.tile_kwargs)
 
     # --- GAN training --------------------------------------------------------
+    if cache:
+        from utils.tile_cache import build_tile_cache, gan_train_from_cache
+        cache_dir = build_tile_cache(
+            dataset,
+            dest=join(P.root, 'tile_cache', f'{cfg.tile_px}px_{cfg.tile_um}um'),
+            outcomes=cfg.outcome
+        )
+        print("Initializing GAN training from tile cache...")
+        gan_train_from_cache(
+            P,
+            dataset=dataset,
+            cache=cache_dir,
+            outcomes=cfg.outcome,
+            **cfg.gan_kwargs
+        )
+        return
+
     print("Initializing GAN training...")
     P.gan_train(
         dataset=dataset,
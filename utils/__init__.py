@@ -1,14 +1,19 @@
 """Utility functions"""
 
 import os
+import json
+import queue
+import multiprocessing as mp
 import tarfile
 import shutil
 import hashlib
+import threading
+import requests
 import pandas as pd
 import slideflow as sf
 
 from os.path import join, exists, basename
-from typing import List, Any, Dict, Optional
+from typing import List, Any, Dict, Optional, Tuple, Callable
 from tqdm import tqdm
 from slideflow.util import download_from_tcga
 
@@ -52,6 +57,40 @@ def download_slides(slides: List[str], dest: str, manifest: Dict[str, str]):
                            message=f"Downloading {i+1} of {len(to_download)}...")
 
 
+def download_slide(
+    uuid: str,
+    path: str,
+    timeout: Tuple[float, float] = (30, 300)
+) -> str:
+    """Download a single file from TCGA (GDC) by UUID, returning the MD5
+    checksum computed while the file is streamed to disk.
+
+    The file is written to a temporary ``.part`` file and only moved to
+    the destination once the download has completed. ``timeout`` gives the
+    (connect, read) timeouts in seconds, so that a stalled connection
+    raises an error rather than blocking indefinitely."""
+    m = hashlib.md5()
+    try:
+        with requests.post(
+            "https://api.gdc.cancer.gov/data/",
+            data=json.dumps({'ids': [uuid]}),
+            headers={"Content-Type": "application/json"},
+            stream=True,
+            timeout=timeout
+        ) as response:
+            response.raise_for_status()
+            with open(path + '.part', 'wb') as f:
+                for chunk in response.iter_content(chunk_size=4096):
+                    f.write(chunk)
+                    m.update(chunk)
+    except BaseException:
+        if exists(path + '.part'):
+            os.remove(path + '.part')
+        raise
+    os.replace(path + '.part', path)
+    return m.hexdigest()
+
+
 def verify_md5(
     dest: str,
     manifest: Dict[str, str],
@@ -79,6 +118,185 @@ def verify_md5(
     return failed_md5
 
 
+def _run_stage(
+    fn: Callable,
+    q_in: queue.Queue,
+    q_out: Optional[queue.Queue],
+    errors: List[BaseException]
+) -> None:
+    """Run one stage of the slide preparation pipeline.
+
+    Items are read from ``q_in`` until a ``None`` sentinel is received, and
+    results which are not None are passed to ``q_out``. If any stage has
+    failed or the pipeline has been cancelled (``errors`` is not empty),
+    remaining items are drained without processing so that upstream stages
+    are not blocked on a full queue. The sentinel is always passed on, so
+    downstream stages finish even if this stage fails."""
+    try:
+        while (item := q_in.get()) is not None:
+            if errors:
+                continue
+            try:
+                result = fn(item)
+            except BaseException as e:
+                errors.append(e)
+                continue
+            if result is not None and q_out is not None:
+                q_out.put(result)
+    finally:
+        if q_out is not None:
+            q_out.put(None)
+
+
+def pipeline_slides(
+    dataset: sf.Dataset,
+    source: str,
+    tile_kwargs: Dict[str, Any],
+    slide_manifest: Optional[Dict[str, str]] = None,
+    md5_manifest: Optional[Dict[str, str]] = None,
+    queue_size: int = 2
+) -> List[str]:
+    """Download, verify, and extract tiles from slides in a pipeline.
+
+    Each slide moves through the download, MD5 verification, and tile
+    extraction stages as soon as the previous stage has finished with it,
+    with bounded queues between stages. MD5 checksums for newly downloaded
+    slides are computed while the file is streamed to disk. A single
+    extraction pool is shared by all slides, and the TFRecord manifest is
+    updated once all slides have been extracted.
+
+    Args:
+        dataset (sf.Dataset): Dataset (with tile_px and tile_um set) from
+            which to extract tiles.
+        source (str): Name of the dataset source to prepare.
+        tile_kwargs (dict): Keyword arguments for ``Dataset.extract_tiles``.
+        slide_manifest (dict, optional): Maps slide filenames to TCGA UUIDs.
+            If not provided, slides are not downloaded.
+        md5_manifest (dict, optional): Maps slide filenames to MD5 hashes.
+            If not provided, slides are not verified.
+        queue_size (int): Maximum number of slides waiting between stages.
+
+    Returns:
+        List of slide filenames which failed MD5 verification. Tiles are
+        not extracted from these slides.
+    """
+    src = dataset.sources[source]
+    dest = src['slides']
+    tfrecord_dir = join(src['tfrecords'], src['label'])
+    for d in (dest, tfrecord_dir):
+        if not exists(d):
+            os.makedirs(d)
+    slides = dataset.slides()
+
+    # Split Dataset.extract_tiles arguments into slide loading, quality
+    # control, and tile extraction arguments.
+    tile_kwargs = {k: v for k, v in tile_kwargs.items() if k != 'report'}
+    qc = tile_kwargs.pop('qc', None)
+    qc_kwargs = {k[3:]: v for k, v in tile_kwargs.items() if k[:3] == 'qc_'}
+    wsi_kwargs = {k: tile_kwargs.pop(k) for k in ('roi_method', 'stride_div',
+                                                  'enable_downsample',
+                                                  'randomize_origin')
+                  if k in tile_kwargs}
+    tile_kwargs = {k: v for k, v in tile_kwargs.items() if k[:3] != 'qc_'}
+    num_threads = tile_kwargs.pop('num_threads', os.cpu_count() or 8)
+
+    failed_md5 = []
+    errors = []  # type: List[BaseException]
+    pbar = tqdm(total=len(slides), desc="Preparing slides")
+
+    def download(slide: str) -> Optional[Tuple[str, str, Optional[str]]]:
+        path = join(dest, f'{slide}.svs')
+        if exists(path):
+            return slide, path, None
+        if slide_manifest is None or f'{slide}.svs' not in slide_manifest:
+            pbar.update()
+            return None
+        tqdm.write(f"Downloading {slide}...")
+        return slide, path, download_slide(slide_manifest[f'{slide}.svs'], path)
+
+    def verify(item: Tuple[str, str, Optional[str]]) -> Optional[Tuple[str, str]]:
+        slide, path, checksum = item
+        filename = basename(path)
+        if md5_manifest is not None and filename in md5_manifest:
+            if checksum is None:
+                checksum = md5(path)
+            if checksum != md5_manifest[filename]:
+                tqdm.write(f"Slide {filename} failed MD5 verification")
+                failed_md5.append(filename)
+                pbar.update()
+                return None
+        return slide, path
+
+    def extract(item: Tuple[str, str]) -> None:
+        slide, path = item
+        if (exists(join(tfrecord_dir, f'{slide}.tfrecords'))
+           and not exists(join(tfrecord_dir, f'{slide}.unfinished'))):
+            pbar.update()
+            return
+        try:
+            wsi = sf.WSI(path,
+                         tile_px=dataset.tile_px,
+                         tile_um=dataset.tile_um,
+                         roi_dir=src['roi'],
+                         **wsi_kwargs)
+            if qc:
+                wsi.qc(method=qc, **qc_kwargs)
+            # Without a shared pool (num_threads=1), pass num_threads so
+            # slideflow does not fall back to a thread per CPU.
+            if pool is not None:
+                pool_kwargs = dict(pool=pool)
+            else:
+                pool_kwargs = dict(num_threads=num_threads)
+            wsi.extract_tiles(tfrecord_dir=tfrecord_dir,
+                              report=False,
+                              **pool_kwargs,
+                              **tile_kwargs)
+        except (sf.errors.MissingROIError, sf.errors.SlideLoadError,
+                sf.errors.QCError, sf.errors.TileCorruptionError) as e:
+            tqdm.write(f"Skipping slide {slide}: {e}")
+        pbar.update()
+
+    # Set up stages, connected by bounded queues.
+    q_slides = queue.Queue()  # type: queue.Queue
+    q_verify = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+    q_extract = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+    stages = [
+        threading.Thread(target=_run_stage,
+                         args=(fn, q_in, q_out, errors),
+                         daemon=True)
+        for fn, q_in, q_out in ((download, q_slides, q_verify),
+                                (verify, q_verify, q_extract),
+                                (extract, q_extract, None))
+    ]
+    # Forking is incompatible with some libvips configurations. The spawn
+    # context is used directly so that the global start method is not set.
+    pool = mp.get_context('spawn').Pool(num_threads) if num_threads != 1 else None
+    try:
+        for stage in stages:
+            stage.start()
+        for slide in slides:
+            q_slides.put(slide)
+        q_slides.put(None)
+        for stage in stages:
+            stage.join()
+    except BaseException as e:
+        # Cancel remaining work (e.g. on KeyboardInterrupt).
+        errors.append(e)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+        pbar.close()
+
+    if errors:
+        raise errors[0]
+
+    # Update manifest & rebuild indices.
+    dataset.update_manifest(force_update=True)
+    dataset.build_index(True)
+    return failed_md5
+
+
 def resolve_relative_paths(cfg: EasyDict, path: str) -> EasyDict:
     """Convert relative paths into absolute paths."""
 
@@ -107,9 +325,15 @@ def prepare_project(
     path: str,
     cfg: EasyDict,
     md5: bool,
-    download: bool
+    download: bool,
+    pipeline: bool = False
 ) -> sf.Project:
-    """Prepare a given project, downloading and verifying missing slides."""
+    """Prepare a given project, downloading and verifying missing slides.
+
+    If ``pipeline`` is True, slides are downloaded, verified, and tiles
+    extracted in a pipeline, with each slide moving to the next stage as
+    soon as the previous stage has finished.
+    """
 
     # Initialize project in out directory.
     if sf.util.is_project(path):
@@ -140,7 +364,28 @@ def prepare_project(
     if download and slide_manifest is None:
         print("Unable to download slides; could not find valid TCGA manifest "
               "at experiments/gdc_manifest.tsv")
-    elif download:
+        download = False
+    if md5 and md5_manifest is None:
+        print("Unable to verify slides; could not find valid TCGA manifest "
+              "at experiments/gdc_manifest.tsv")
+        md5 = False
+
+    # Pipelined download, verification, and tile extraction.
+    if pipeline:
+        print(f"Preparing slides at {slide_dest}...")
+        failed = pipeline_slides(
+            P.dataset(tile_px=cfg.tile_px, tile_um=cfg.tile_um),
+            source=cfg.name,
+            tile_kwargs=cfg.tile_kwargs,
+            slide_manifest=(slide_manifest if download else None),
+            md5_manifest=(md5_manifest if md5 else None)
+        )
+        download, md5 = False, False
+        if failed:
+            print(f"Warning: {len(failed)} slides failed MD5 verification.")
+            raise ValueError("MD5 verification failed.")
+
+    if download:
         print(f"Downloading slides to {slide_dest}...")
         download_slides(slides=dataset.slides(),
                         dest=slide_dest,
@@ -154,12 +399,9 @@ def prepare_project(
               "Download slides from TCGA with the --download flag")
 
     # MD5 hash verification.
-    if md5 and md5_manifest is None:
-        print("Unable to download slides; could not find valid TCGA manifest "
-              "at experiments/gdc_manifest.tsv")
-    elif md5 and exists(slide_dest):
+    if md5 and exists(slide_dest):
         failed = verify_md5(slide_dest, md5_manifest)
         if failed:
             raise ValueError("MD5 verification failed.")
 
-    return P
\ No newline at end of file
+    return P
@@ -0,0 +1,299 @@
+"""Decoded, memory-mapped tile cache for GAN training."""
+
+import os
+import json
+import random
+import numpy as np
+import slideflow as sf
+
+from io import BytesIO
+from functools import partial
+from os.path import join, exists
+from typing import Any, Callable, List, Optional, Tuple
+from multiprocessing.dummy import Pool as DPool
+from PIL import Image
+from tqdm import tqdm
+from slideflow.gan.stylegan3.stylegan3 import dnnlib
+from slideflow.gan.stylegan3.stylegan3.training.dataset import Dataset
+
+# -----------------------------------------------------------------------------
+
+class TileCacheDataset(Dataset):
+    """StyleGAN3 training dataset which reads decoded tiles from a
+    memory-mapped tile cache, built with :func:`build_tile_cache`.
+
+    Images are returned as views into the memory-mapped cache, and are
+    only copied when collated into a batch. If ``xflip`` is True, images
+    are randomly flipped and rotated, matching the 'xyr' augmentation used
+    when training from TFRecords.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        resolution: Optional[int] = None,
+        xflip: bool = False,
+        **super_kwargs: Any
+    ) -> None:
+        self._path = path
+        self._images = None
+        self._augment = xflip
+        with open(join(path, 'cache.json'), 'r') as f:
+            self._cache_cfg = json.load(f)
+        raw_shape = np.load(join(path, 'images.npy'), mmap_mode='r').shape
+        if resolution is not None and raw_shape[2:] != (resolution, resolution):
+            raise IOError('Tile cache does not match the specified resolution')
+        super().__init__(name=self._cache_cfg['name'],
+                         raw_shape=raw_shape,
+                         xflip=False,
+                         **super_kwargs)
+
+    def _get_images(self) -> np.ndarray:
+        # Opened lazily, so that each DataLoader worker maps the file itself.
+        # Copy-on-write mode returns writable arrays without reading the
+        # whole file into memory.
+        if self._images is None:
+            self._images = np.load(join(self._path, 'images.npy'), mmap_mode='c')
+        return self._images
+
+    def _load_raw_image(self, raw_idx: int) -> np.ndarray:
+        return self._get_images()[raw_idx]
+
+    def _load_raw_labels(self) -> Optional[np.ndarray]:
+        if not exists(join(self._path, 'labels.npy')):
+            return None
+        return np.load(join(self._path, 'labels.npy'))
+
+    def __getstate__(self):
+        return dict(super().__getstate__(), _images=None)
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        image = self._load_raw_image(self._raw_idx[idx])
+        if self._augment:
+            if random.random() < 0.5:
+                image = image[:, :, ::-1]
+            if random.random() < 0.5:
+                image = image[:, ::-1, :]
+            image = np.rot90(image, k=random.randint(0, 3), axes=(1, 2))
+            image = np.ascontiguousarray(image)
+        return image, self.get_label(idx)
+
+
+def _init_cache_kwargs(
+    path: str,
+    init_slideflow_kwargs: Callable
+) -> Tuple[dnnlib.EasyDict, dnnlib.EasyDict, str]:
+    """Training set configuration for a tile cache. Used in place of the
+    StyleGAN3 Slideflow configuration when training from a cache.
+
+    The Slideflow options (tile size and outcome labels) are kept, so that
+    they are saved in ``training_options.json`` as for any other network,
+    but the training set reads from the cache given by ``tile_cache``."""
+    _, slideflow_kwargs, name = init_slideflow_kwargs(path=path)
+    dataset_obj = TileCacheDataset(path=slideflow_kwargs.tile_cache,
+                                   use_labels=True)
+    outcome_labels = slideflow_kwargs.outcome_labels
+    if outcome_labels is not None and (not dataset_obj.has_labels
+                                       or dataset_obj.label_dim != len(outcome_labels)):
+        raise ValueError(f"Tile cache at {slideflow_kwargs.tile_cache} does "
+                         "not contain labels matching the outcome labels "
+                         f"{list(outcome_labels.values())}; rebuild the cache.")
+    dataset_kwargs = dnnlib.EasyDict(
+        class_name='utils.tile_cache.TileCacheDataset',
+        path=slideflow_kwargs.tile_cache,
+        use_labels=dataset_obj.has_labels,
+        max_size=len(dataset_obj),
+        xflip=False,
+        resolution=dataset_obj.resolution
+    )
+    return dataset_kwargs, slideflow_kwargs, name
+
+# -----------------------------------------------------------------------------
+
+def build_tile_cache(
+    dataset: sf.Dataset,
+    dest: str,
+    outcomes: Optional[str] = None,
+    num_threads: int = 8
+) -> str:
+    """Decode all tiles in a dataset into a memory-mapped tile cache.
+
+    The cache contains ``images.npy``, a uint8 array of shape (N, C, H, W),
+    ``labels.npy`` with the categorical label index of each tile (if
+    ``outcomes`` is provided), and ``cache.json``, which is written last
+    and describes the cached dataset. If a complete cache for the same
+    outcome labels and unmodified tfrecords (by size and modification time)
+    already exists at the destination, it is reused.
+
+    Args:
+        dataset (sf.Dataset): Dataset of extracted tiles.
+        dest (str): Directory in which to build the cache.
+        outcomes (str, optional): Categorical outcome used for labels.
+        num_threads (int): Number of threads used for decoding.
+
+    Returns:
+        Path to the tile cache.
+    """
+    manifest = dataset.manifest()
+    tfrecords = sorted(dataset.tfrecords())
+    n_tiles = [manifest[tfr]['total'] for tfr in tfrecords]
+    cache_cfg = dict(
+        name=sf.util.path_to_name(dest),
+        tile_px=dataset.tile_px,
+        tile_um=dataset.tile_um,
+        outcomes=outcomes,
+        tfrecords={tfr: [os.path.getsize(tfr), os.path.getmtime(tfr)]
+                   for tfr in tfrecords},
+        num_tiles=sum(n_tiles)
+    )
+
+    # Labels, included in the configuration so that changed annotations
+    # invalidate the cache.
+    if outcomes is not None:
+        labels, unique = dataset.labels(outcomes, use_float=False)
+        cache_cfg['outcome_labels'] = list(unique)
+        cache_cfg['slide_labels'] = {
+            sf.util.path_to_name(tfr): int(labels[sf.util.path_to_name(tfr)])
+            for tfr in tfrecords
+        }
+
+    # Reuse an existing, complete cache.
+    if exists(join(dest, 'cache.json')):
+        with open(join(dest, 'cache.json'), 'r') as f:
+            existing = json.load(f)
+        if {k: existing.get(k) for k in cache_cfg} == cache_cfg:
+            print(f"Using existing tile cache at {dest}")
+            return dest
+        print(f"Tile cache at {dest} is out of date; rebuilding.")
+        os.remove(join(dest, 'cache.json'))
+    if not exists(dest):
+        os.makedirs(dest)
+
+    # Labels.
+    if outcomes is not None:
+        tile_labels = np.concatenate([
+            np.full(n, cache_cfg['slide_labels'][sf.util.path_to_name(tfr)],
+                    dtype=np.int64)
+            for tfr, n in zip(tfrecords, n_tiles)
+        ])
+        np.save(join(dest, 'labels.npy'), tile_labels)
+    elif exists(join(dest, 'labels.npy')):
+        os.remove(join(dest, 'labels.npy'))
+
+    # Decode images into the memory-mapped array. Each tfrecord is written
+    # to its own range of the array, so tfrecords can be decoded in parallel.
+    images = np.lib.format.open_memmap(
+        join(dest, 'images.npy'),
+        mode='w+',
+        dtype=np.uint8,
+        shape=(sum(n_tiles), 3, dataset.tile_px, dataset.tile_px)
+    )
+    offsets = np.cumsum([0] + n_tiles[:-1])
+    pbar = tqdm(total=sum(n_tiles), desc="Building tile cache")
+
+    def decode_tfrecord(args: Tuple[str, int, int]) -> None:
+        tfr, start, n = args
+        parser = sf.io.get_tfrecord_parser(tfr,
+                                           ('image_raw',),
+                                           decode_images=False,
+                                           to_numpy=True)
+        i = 0
+        for record in sf.io.TFRecordDataset(tfr):
+            if i >= n:
+                raise ValueError(f"TFRecord {tfr} has more records than "
+                                 "expected; update the dataset manifest.")
+            img_bytes = BytesIO(bytes(parser(record)[0]))
+            image = np.asarray(Image.open(img_bytes).convert('RGB'))
+            images[start + i] = image.transpose(2, 0, 1)
+            pbar.update()
+            i += 1
+        if i != n:
+            raise ValueError(f"TFRecord {tfr} has fewer records than "
+                             "expected; update the dataset manifest.")
+
+    with DPool(num_threads) as pool:
+        for _ in pool.imap_unordered(decode_tfrecord,
+                                     zip(tfrecords, offsets, n_tiles)):
+            pass
+    pbar.close()
+    images.flush()
+    del images
+
+    with open(join(dest, 'cache.json'), 'w') as f:
+        json.dump(cache_cfg, f, indent=2)
+    return dest
+
+
+def gan_train_from_cache(
+    P: sf.Project,
+    dataset: sf.Dataset,
+    cache: str,
+    *,
+    model: str = 'stylegan3',
+    outcomes: Optional[str] = None,
+    exp_label: Optional[str] = None,
+    mirror: bool = True,
+    metrics: Optional[List[str]] = None,
+    dry_run: bool = False,
+    **kwargs: Any
+) -> None:
+    """Train a GAN from a tile cache built with :func:`build_tile_cache`.
+
+    Equivalent to ``P.gan_train``, but training images are read from the
+    decoded tile cache with a shuffling sampler and multi-worker data
+    loading, rather than decoded from TFRecords.
+
+    The saved ``training_options.json`` records the training set class as
+    ``utils.tile_cache.TileCacheDataset``, so StyleGAN3 tools which rebuild
+    the training set from these options (e.g. ``calc_metrics``) require
+    this repository to be on ``sys.path``.
+    """
+    if model != 'stylegan3':
+        raise ValueError("Training from a tile cache is only supported "
+                         "for model 'stylegan3'.")
+    from slideflow.gan.stylegan3 import stylegan3 as network
+    if metrics is not None:
+        sf.log.warn(
+            "StyleGAN2 metrics are not fully implemented for Slideflow."
+        )
+
+    # Setup directories
+    gan_root = join(P.root, 'gan')
+    if not exists(gan_root):
+        os.makedirs(gan_root)
+    if exp_label is None:
+        exp_label = 'gan_experiment'
+    gan_dir = sf.util.get_new_model_dir(gan_root, exp_label)
+
+    # Write GAN configuration
+    config_loc = join(gan_dir, 'slideflow_config.json')
+    sf.util.write_json(dict(
+        project_path=P.root,
+        tile_px=dataset.tile_px,
+        tile_um=dataset.tile_um,
+        model_type='categorical',
+        outcome_label_headers=outcomes,
+        filters=dataset._filters,
+        filter_blank=dataset._filter_blank,
+        tile_cache=cache,
+    ), config_loc)
+
+    # The StyleGAN3 training script builds its Slideflow training set from
+    # TFRecords; read from the tile cache instead.
+    init_slideflow_kwargs = network.train.init_slideflow_kwargs
+    network.train.init_slideflow_kwargs = partial(
+        _init_cache_kwargs,
+        init_slideflow_kwargs=init_slideflow_kwargs
+    )
+    try:
+        network.train.train(
+            ctx=None,
+            outdir=gan_dir,
+            dry_run=dry_run,
+            slideflow=config_loc,
+            cond=(outcomes is not None),
+            mirror=mirror,
+            metrics=metrics,
+            **kwargs)
+    finally:
+        network.train.init_slideflow_kwargs = init_slideflow_kwargs